@@ -1,14 +1,18 @@
+import copy
+import io
 import random
 import os
+import re
 import sys
 import tempfile
 import shutil
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 
 # Optional Pillow
 try:
-    from PIL import Image, ImageTk
+    from PIL import Image, ImageOps, ImageTk
     PIL_AVAILABLE = True
 except Exception:
     Image = None
@@ -32,10 +36,14 @@ except ImportError:
 try:
     from docx import Document
     from docx.shared import Inches
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
     DOCX_AVAILABLE = True
 except Exception:
     Document = None
     Inches = None
+    parse_xml = None
+    nsdecls = None
     DOCX_AVAILABLE = False
 
 # Optional SVG -> PNG conversion support
@@ -46,48 +54,139 @@ except Exception:
     cairosvg = None
     CAIROSVG_AVAILABLE = False
 
+# Optional Aho-Corasick automaton for matching QIDs inside file names
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except Exception:
+    ahocorasick = None
+    AHOCORASICK_AVAILABLE = False
+
+
+# Creation time printed in exam headers
+_CREATED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Upper bound on threads used to write exam files in parallel
+_MAX_SAVE_WORKERS = 8
+
+# Buffer size for reading question bank files
+_READ_BUFFER_SIZE = 1 << 20
+
+# Buffer sizes for exam output files (text bodies are joined and written once)
+_WRITE_BUFFER_SIZE = 1 << 16
+_DOCX_BUFFER_SIZE = 1 << 20
+
+
+# Images larger than this are downscaled to _EMBED_DPI before embedding in docx
+_SHRINK_MIN_BYTES = 256 * 1024
+_EMBED_DPI = 200
 
 # Helper: convert various formats to PNG usable by python-docx
-def _convert_to_png(src_path):
-    """Return path to a PNG file converted from src_path, or None if conversion failed/not possible."""
-    if not os.path.exists(src_path):
-        return None
-    base, ext = os.path.splitext(src_path)
-    ext = ext.lower()
+def _convert_to_png_bytes(src_path, cache=None):
+    """Return a BytesIO with src_path converted to PNG, or None if conversion failed/not possible.
+    The conversion is done in memory, so no intermediate file is written. With a `cache`
+    dict (owned by one save call) each source is converted only once.
+    """
+    data = cache.get(src_path) if cache is not None else None
+    if data is None:
+        data = _render_png(src_path)
+        if data is None:
+            return None
+        if cache is not None:
+            cache[src_path] = data
+    return io.BytesIO(data)
+
+
+def _render_png(src_path):
+    """Return PNG bytes rendered from src_path, or None."""
+    ext = os.path.splitext(src_path)[1].lower()
     # SVG via cairosvg
     if ext == '.svg' and CAIROSVG_AVAILABLE:
         try:
-            dst = base + '.png'
-            if not os.path.exists(dst):
-                cairosvg.svg2png(url=src_path, write_to=dst)
-            return dst
+            return cairosvg.svg2png(url=src_path)
         except Exception:
             return None
     # Use Pillow for other conversions (jfif, etc.)
     if PIL_AVAILABLE:
         try:
-            dst = base + '_conv.png'
             img = Image.open(src_path)
             # convert to RGB if necessary
             if img.mode in ('RGBA', 'LA'):
                 img = img.convert('RGBA')
             else:
                 img = img.convert('RGB')
-            img.save(dst, format='PNG')
-            return dst
+            # fast, lightly compressed encode: these PNGs only feed docx embedding
+            buf = io.BytesIO()
+            img.save(buf, format='PNG', optimize=False, compress_level=1)
+            return buf.getvalue()
         except Exception:
             return None
     return None
 
 
-def _embed_image_in_paragraph(par, img_path, width_inch=2.5):
-    """Try to embed image into a paragraph; try conversions if necessary. Returns True if embedded."""
+def _shrink_for_docx(img_path, width_inch):
+    """Return a BytesIO with a large raster image downscaled to its display size, or None.
+    Opaque images are re-encoded as JPEG; transparent ones as a palette PNG.
+    """
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        if os.path.getsize(img_path) <= _SHRINK_MIN_BYTES:
+            return None
+        img = Image.open(img_path)
+        # the re-encoded copy carries no EXIF, so apply the camera orientation first
+        img = ImageOps.exif_transpose(img)
+        target = int(width_inch * _EMBED_DPI)
+        img.thumbnail((target, target))
+        buf = io.BytesIO()
+        if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+            # keep the alpha channel: FASTOCTREE is the quantizer that supports RGBA
+            img = img.convert('RGBA').quantize(method=Image.FASTOCTREE)
+            img.save(buf, format='PNG')
+        else:
+            img.convert('RGB').save(buf, format='JPEG', quality=82, optimize=True, progressive=True)
+        buf.seek(0)
+        return buf
+    except Exception:
+        return None
+
+
+def _prepared_image(img_path, width_inch, cache=None):
+    """Return what add_picture should read for img_path (downscaled if large).
+    With a `cache` dict the prepared bytes are kept per (path, width), so an image
+    used several times in one document is read from disk and resized only once.
+    """
+    if cache is None:
+        return _shrink_for_docx(img_path, width_inch) or img_path
+    key = (img_path, width_inch)
+    data = cache.get(key)
+    if data is None:
+        small = _shrink_for_docx(img_path, width_inch)
+        if small:
+            data = small.getvalue()
+        else:
+            with open(img_path, 'rb') as f:
+                data = f.read()
+        cache[key] = data
+    return io.BytesIO(data)
+
+
+def _embed_image_in_paragraph(par, img, width_inch=2.5, cache=None):
+    """Try to embed image (a path or a file-like object) into a paragraph; try conversions
+    if necessary. Returns True if embedded. `cache` is passed on to _prepared_image.
+    """
+    if not isinstance(img, str):
+        try:
+            par.add_run().add_picture(img, width=Inches(width_inch))
+            return True
+        except Exception:
+            return False
     try:
-        par.add_run().add_picture(img_path, width=Inches(width_inch))
+        par.add_run().add_picture(_prepared_image(img, width_inch, cache), width=Inches(width_inch))
         return True
     except Exception:
         # try conversion
-        conv = _convert_to_png(img_path)
+        conv = _convert_to_png_bytes(img)
         if conv:
             try:
                 par.add_run().add_picture(conv, width=Inches(width_inch))
@@ -97,13 +196,27 @@ def _embed_image_in_paragraph(par, img_path, width_inch=2.5):
         return False
 
 
+def _no_borders_xml(tag, sides):
+    """Build a <w:tag> element with every side in `sides` set to no border."""
+    nodes = ''.join(f'<w:{b} w:val="none" w:sz="0" w:space="0"/>' for b in sides)
+    return parse_xml(f'<w:{tag} {nsdecls("w")}>{nodes}</w:{tag}>')
+
+
+# Border templates, deep-copied onto each table/cell by _hide_table_borders
+if DOCX_AVAILABLE:
+    _TBL_BORDERS_XML = _no_borders_xml('tblBorders', ('top', 'left', 'bottom', 'right', 'insideH', 'insideV'))
+    _TC_BORDERS_XML = _no_borders_xml('tcBorders', ('top', 'left', 'bottom', 'right'))
+else:
+    _TBL_BORDERS_XML = None
+    _TC_BORDERS_XML = None
+
+
 def _hide_table_borders(table):
     """Remove/hide borders from a docx table for a cleaner inline layout."""
     if not DOCX_AVAILABLE:
         return
     try:
         from docx.oxml import OxmlElement
-        from docx.oxml.ns import qn
         tbl = table._element
         # ensure tblPr exists
         tblPr = getattr(tbl, 'tblPr', None)
@@ -114,14 +227,7 @@ def _hide_table_borders(table):
         for child in list(tblPr):
             if 'tblBorders' in child.tag:
                 tblPr.remove(child)
-        tblBorders = OxmlElement('w:tblBorders')
-        for b in ('top', 'left', 'bottom', 'right', 'insideH', 'insideV'):
-            node = OxmlElement(f'w:{b}')
-            node.set(qn('w:val'), 'none')
-            node.set(qn('w:sz'), '0')
-            node.set(qn('w:space'), '0')
-            tblBorders.append(node)
-        tblPr.append(tblBorders)
+        tblPr.append(copy.deepcopy(_TBL_BORDERS_XML))
 
         # Also clear borders on each cell
         for row in table.rows:
@@ -135,43 +241,66 @@ def _hide_table_borders(table):
                 for child in list(tcPr):
                     if 'tcBorders' in child.tag:
                         tcPr.remove(child)
-                tcBorders = OxmlElement('w:tcBorders')
-                for b in ('top', 'left', 'bottom', 'right'):
-                    node = OxmlElement(f'w:{b}')
-                    node.set(qn('w:val'), 'none')
-                    node.set(qn('w:sz'), '0')
-                    node.set(qn('w:space'), '0')
-                    tcBorders.append(node)
-                tcPr.append(tcBorders)
+                tcPr.append(copy.deepcopy(_TC_BORDERS_XML))
     except Exception:
         pass
 
 # Global
 loaded_questions = []
-images_map = {}  # mapping qid -> list of image paths
+images_map = {}  # mapping qid -> set of attachment paths
+
+# Precompiled patterns used by the question bank parser
+_OPT_PREFIX_RE = re.compile(r'^[A-Da-d]\s*[.)]\s*')
+_SPLIT_RE = re.compile(r'[;|,]')
+_SINGLE_LETTER_RE = re.compile(r'^[A-Da-d]$')
+_TRAILING_LETTER_RE = re.compile(r'\|?\s*([A-Da-d])\s*$')
+
+# Shared immutable default for "no attachments" lookups
+_EMPTY = ()
+
+# Difficulty levels (in allocation order) and question types
+_LEVELS = ('NB', 'TH', 'VD', 'VDH')
+_VALID_TYPES = frozenset(('MCQ', 'ESSAY'))
+
+# Height in pixels of one file row in the attachment assignment dialog
+_ASSIGN_ROW_HEIGHT = 96
+
+# Thumbnails kept in memory across openings of the assignment dialog
+_THUMB_CACHE_SIZE = 200
+
+# Option labels; the parser always yields four options per question
+_OPT_LETTERS = ('A', 'B', 'C', 'D')
+
+# One drag & drop token: either {path with spaces} or a bare path
+_DND_TOKEN_RE = re.compile(r'\{([^}]*)\}|(\S+)')
+
 
 def read_questions_from_file(filename):
     """Đọc và parse file ngân hàng câu hỏi"""
-    import re
     questions = []
+    append = questions.append
+    strip_prefix = _OPT_PREFIX_RE.sub
+    split = _SPLIT_RE.split
+    is_letter = _SINGLE_LETTER_RE.match
+    trailing_letter = _TRAILING_LETTER_RE.search
+
     def clean_opt(s):
         s = s.strip()
         # remove surrounding braces or parentheses
-        if s.startswith('{') and s.endswith('}'):
+        if s[:1] == '{' and s[-1:] == '}':
             s = s[1:-1].strip()
-        s = re.sub(r'^[A-Da-d]\s*[\.|\)]\s*', '', s)
-        return s.strip()
+        # the prefix pattern already eats the spaces after "A." / "A)"
+        return strip_prefix('', s)
 
     def split_combined_options(s):
         # Split on semicolon, pipe or / and comma but keep order
-        parts = re.split(r';|\||,', s)
-        return [clean_opt(p) for p in parts if p.strip()]
+        return [clean_opt(p) for p in split(s) if p.strip()]
 
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
+        with open(filename, 'r', encoding='utf-8', buffering=_READ_BUFFER_SIZE) as f:
+            raw = f.read()
 
-        lines = [line.strip() for line in content.split('\n') if line.strip()]
+        lines = [line for line in (ln.strip() for ln in raw.splitlines()) if line]
 
         for line in lines:
             # Skip non-question lines except manual trailing ones
@@ -181,7 +310,7 @@ def read_questions_from_file(filename):
                         level_part = line.split('(')[1].split(')')[0].strip().upper()
                         question_text = line.split(')')[1].split('(đáp án')[0].strip().rstrip(' –-')
                         qtype = 'MCQ' if any(opt in question_text for opt in ['A.', 'B.', 'C.', 'D.']) else 'ESSAY'
-                        questions.append({
+                        append({
                             'id': f"MANUAL{len(questions)+1:03d}",
                             'level': level_part,
                             'type': qtype,
@@ -199,11 +328,11 @@ def read_questions_from_file(filename):
             if len(parts) < 5:
                 continue
 
-            qid = parts[0].strip()
-            level = parts[1].strip().upper()
-            qtype_raw = parts[2].strip().upper()
-            subject = parts[3].strip()
-            question_text = parts[4].strip()
+            # only the header fields are stripped here: the tail is parsed as written
+            # (e.g. whitespace-only option fields still select the explicit-options case)
+            qid, level, qtype_raw, subject, question_text = [p.strip() for p in parts[:5]]
+            level = level.upper()
+            qtype_raw = qtype_raw.upper()
 
             qtype = 'ESSAY' if 'ESSAY' in qtype_raw or 'TL' in qtype_raw else 'MCQ'
 
@@ -227,7 +356,7 @@ def read_questions_from_file(filename):
                     if tail:
                         # if last token is single letter (A-D) treat as answer
                         last = tail[-1].strip()
-                        if re.match(r'^[A-Da-d]$', last):
+                        if is_letter(last):
                             answer = last.upper()
                             opt_source = ' | '.join(tail[:-1])
                         else:
@@ -240,17 +369,14 @@ def read_questions_from_file(filename):
                         # try to detect answer inside tail if not set
                         if not answer:
                             for t in tail:
-                                if re.match(r'^[A-Da-d]$', t.strip()):
+                                if is_letter(t.strip()):
                                     answer = t.strip().upper()
                                     break
                                 # or last token of tail might be like 'B' or 'C'
                             # also check for single-letter at end of line
-                            m = re.search(r'\|?\s*([A-Da-d])\s*$', line)
+                            m = trailing_letter(line)
                             if m:
                                 answer = m.group(1).upper()
-                        # everything else after options perhaps hint
-                        if len(found_opts) < len(split_combined_options(opt_source)):
-                            hint = ''
                         # if still empty, try remaining tail parts as hint
                         if not hint and len(tail) > (1 if answer else 0):
                             possible = tail[-1] if not answer else ' '.join(tail[1:])
@@ -259,7 +385,7 @@ def read_questions_from_file(filename):
                 # Essay: join any tail as hint/notes
                 hint = ' '.join(tail).strip()
 
-            questions.append({
+            append({
                 'id': qid,
                 'level': level,
                 'type': qtype,
@@ -277,13 +403,30 @@ def read_questions_from_file(filename):
     return questions
 
 
-def format_question(q, index, show_answers=False, show_hints=False):
-    """Định dạng đẹp một câu hỏi"""
-    lines = [f"Câu {index}: [{q['level']}] {q['question']}"]
+def _format_question_full(q, index):
+    """format_question với đầy đủ đáp án và gợi ý (dùng khi ghi file)"""
+    parts = [f"Câu {index}: [{q['level']}] {q['question']}"]
+    options = q['options']
+    if q['type'] == 'MCQ' and any(options):
+        for letter, opt in zip(_OPT_LETTERS, options):
+            if opt.strip():
+                parts.append(f"\n  {letter}. {opt}")
+        answer = q.get('answer')
+        if answer:
+            parts.append(f"\n  Đáp án: {answer}")
+    hint = q.get('hint')
+    if hint:
+        parts.append(f"\n  Gợi ý: {hint}")
+    return ''.join(parts)
+
+
+def _format_question_body(q, show_answers=False, show_hints=False):
+    """Phần nội dung sau "Câu N: " — không phụ thuộc số thứ tự nên có thể dùng lại"""
+    lines = [f"[{q['level']}] {q['question']}"]
     if q['type'] == 'MCQ' and any(q['options']):
-        for i, opt in enumerate(q['options']):
+        for letter, opt in zip(_OPT_LETTERS, q['options']):
             if opt.strip():
-                lines.append(f"  {chr(65 + i)}. {opt}")
+                lines.append(f"  {letter}. {opt}")
         if show_answers and q.get('answer'):
             lines.append(f"  Đáp án: {q['answer']}")
     if show_hints and q.get('hint'):
@@ -291,65 +434,77 @@ def format_question(q, index, show_answers=False, show_hints=False):
     return "\n".join(lines)
 
 
-def generate_versions(questions, N, req_level, req_mcq, req_essay):
-    """Tạo N mã đề theo yêu cầu mức độ và số lượng TN/TL"""
-    bank = {'NB': {'MCQ': [], 'ESSAY': []},
-            'TH': {'MCQ': [], 'ESSAY': []},
-            'VD': {'MCQ': [], 'ESSAY': []},
-            'VDH': {'MCQ': [], 'ESSAY': []}}
+def format_question(q, index, show_answers=False, show_hints=False):
+    """Định dạng đẹp một câu hỏi"""
+    if show_answers and show_hints:
+        return _format_question_full(q, index)
+    return f"Câu {index}: " + _format_question_body(q, show_answers, show_hints)
+
+
+def generate_versions(questions, N, req_level, req_mcq, req_essay, rng=None):
+    """Tạo N mã đề theo yêu cầu mức độ và số lượng TN/TL.
+    Mỗi mã đề trả về đã xếp câu trắc nghiệm trước, tự luận sau.
+    rng: random.Random riêng (mặc định dùng module random)."""
+    if rng is None:
+        rng = random
+    bank = {lev: {'MCQ': [], 'ESSAY': []} for lev in _LEVELS}
+    nb = bank['NB']  # mức độ không hợp lệ được xếp vào NB
     
     for q in questions:
-        lev = q['level']
-        if lev not in bank:
-            lev = 'NB'
-        typ = q['type'] if q['type'] in ['MCQ', 'ESSAY'] else 'ESSAY'
-        bank[lev][typ].append(q)
+        typ = q['type'] if q['type'] in _VALID_TYPES else 'ESSAY'
+        bank.get(q['level'], nb)[typ].append(q)
     
+    # Kho bổ sung không đổi giữa các mã đề nên chỉ dựng một lần
+    all_mcq = [q for lev in bank for q in bank[lev]['MCQ']]
+    all_essay = [q for lev in bank for q in bank[lev]['ESSAY']]
+
     versions = []
     for _ in range(N):
-        selected = []
+        mcq_sel = []
+        essay_sel = []
         remain_mcq = req_mcq
         remain_essay = req_essay
         
         # Phân bổ theo mức độ trước
-        for lev in ['NB', 'TH', 'VD', 'VDH']:
+        for lev in _LEVELS:
             need = req_level.get(lev, 0)
             if need == 0:
                 continue
-            mcq_pool = bank[lev]['MCQ'].copy()
-            essay_pool = bank[lev]['ESSAY'].copy()
-            random.shuffle(mcq_pool)
-            random.shuffle(essay_pool)
+            mcq_pool = bank[lev]['MCQ']
+            essay_pool = bank[lev]['ESSAY']
             
             take_mcq = min(need, remain_mcq, len(mcq_pool))
             take_essay = min(need - take_mcq, remain_essay, len(essay_pool))
             
-            selected.extend(mcq_pool[:take_mcq])
-            selected.extend(essay_pool[:take_essay])
+            mcq_sel.extend(rng.sample(mcq_pool, take_mcq))
+            essay_sel.extend(rng.sample(essay_pool, take_essay))
             
             remain_mcq -= take_mcq
             remain_essay -= take_essay
         
         # Bổ sung thêm nếu còn thiếu
-        all_mcq = [q for lev in bank for q in bank[lev]['MCQ']]
-        all_essay = [q for lev in bank for q in bank[lev]['ESSAY']]
-        random.shuffle(all_mcq)
-        random.shuffle(all_essay)
+        if remain_mcq or remain_essay:
+            mcq_sel.extend(rng.sample(all_mcq, min(remain_mcq, len(all_mcq))))
+            essay_sel.extend(rng.sample(all_essay, min(remain_essay, len(all_essay))))
         
-        selected.extend(all_mcq[:remain_mcq])
-        selected.extend(all_essay[:remain_essay])
-        
-        random.shuffle(selected)
-        versions.append(selected)
+        # Trộn riêng từng phần rồi ghép: TN trước, TL sau
+        rng.shuffle(mcq_sel)
+        rng.shuffle(essay_sel)
+        versions.append(mcq_sel + essay_sel)
     
     return versions
 
 
-def _write_exam_file(path, exam, idx, source_filename=None, copied_map=None, as_docx=False):
+def _write_exam_file(path, exam, idx, source_filename=None, copied_map=None, as_docx=False, created_at=None,
+                     png_cache=None):
     """Write one exam to path. Supports TXT and DOCX (if as_docx=True).
     If as_docx=True, `Document` must be available and copied_map (qid->list of filenames)
     will be used to embed images where possible.
+    created_at is the creation time string printed in the header (defaults to now).
+    png_cache is passed on to _convert_to_png_bytes.
     """
+    if created_at is None:
+        created_at = datetime.now().strftime(_CREATED_AT_FORMAT)
     if as_docx:
         if not DOCX_AVAILABLE:
             print("python-docx không được cài đặt; không thể lưu .docx")
@@ -357,10 +512,9 @@ def _write_exam_file(path, exam, idx, source_filename=None, copied_map=None, as_
         try:
             doc = Document()
             doc.add_heading(f"MÃ ĐỀ {idx}", level=1)
-            doc.add_paragraph(f"Tạo lúc {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            # ensure MCQ appear before ESSAY in the output
-            ordered = [q for q in exam if q.get('type') == 'MCQ'] + [q for q in exam if q.get('type') == 'ESSAY']
-            for q_idx, q in enumerate(ordered, 1):
+            doc.add_paragraph(f"Tạo lúc {created_at}")
+            # exams from generate_versions are already ordered MCQ then ESSAY
+            for q_idx, q in enumerate(exam, 1):
                 # create a two-column table: left for question text, right for attachments (images/files)
                 tbl = doc.add_table(rows=1, cols=2)
                 tbl.autofit = True
@@ -372,22 +526,22 @@ def _write_exam_file(path, exam, idx, source_filename=None, copied_map=None, as_
                 lp.add_run(f"Câu {q_idx}: [{q['level']}] ").bold = True
                 lp.add_run(q['question'])
                 if q['type'] == 'MCQ' and any(q['options']):
-                    for i, opt in enumerate(q['options']):
+                    for letter, opt in zip(_OPT_LETTERS, q['options']):
                         if opt.strip():
-                            left_cell.add_paragraph(f"{chr(65+i)}. {opt}")
+                            left_cell.add_paragraph(f"{letter}. {opt}")
                 if q.get('answer'):
                     left_cell.add_paragraph(f"Đáp án: {q.get('answer')}")
                 if q.get('hint'):
                     left_cell.add_paragraph(f"Gợi ý: {q.get('hint')}")
 
                 # right: embed attachments (images inlined). If multiple, stack vertically
-                for dst in (copied_map or {}).get(q.get('id'), []) or []:
+                for dst in (copied_map or {}).get(q.get('id'), _EMPTY):
                     dst_path = os.path.join(os.path.dirname(path), 'images', dst)
                     ext = os.path.splitext(dst)[1].lower()
                     embedded = False
                     # SVG: try convert then embed
                     if ext == '.svg':
-                        conv = _convert_to_png(dst_path)
+                        conv = _convert_to_png_bytes(dst_path, png_cache)
                         if conv:
                             rp = right_cell.add_paragraph()
                             embedded = _embed_image_in_paragraph(rp, conv, width_inch=2.5)
@@ -400,101 +554,161 @@ def _write_exam_file(path, exam, idx, source_filename=None, copied_map=None, as_
                         right_cell.add_paragraph(f"Tệp đính kèm: images/{dst}")
                 # add spacing
                 doc.add_paragraph('')
-            doc.save(path)
+            with open(path, 'wb', buffering=_DOCX_BUFFER_SIZE) as fh:
+                doc.save(fh)
             return True
         except Exception as e:
             print(f"Lỗi khi ghi docx {path}: {e}")
             return False
     else:
         try:
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(f"MÃ ĐỀ {idx} — Tạo lúc {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-                ordered = [q for q in exam if q.get('type') == 'MCQ'] + [q for q in exam if q.get('type') == 'ESSAY']
-                for q_idx, q in enumerate(ordered, 1):
-                    f.write(format_question(q, q_idx, show_answers=True, show_hints=True) + "\n\n")
+            out = [f"MÃ ĐỀ {idx} — Tạo lúc {created_at}\n\n"]
+            # exams from generate_versions are already ordered MCQ then ESSAY
+            for q_idx, q in enumerate(exam, 1):
+                out.append(_format_question_full(q, q_idx) + "\n\n")
+            # attachment references at end of file
+            if copied_map:
+                out.append('\nTỆP ĐÍNH KÈM:\n')
+                for q in exam:
+                    for dst in copied_map.get(q.get('id'), _EMPTY):
+                        out.append(f"{q.get('id')}: images/{dst}\n")
+            with open(path, 'w', encoding='utf-8', buffering=_WRITE_BUFFER_SIZE) as f:
+                f.write(''.join(out))
             return True
         except Exception as e:
             print(f"Lỗi khi ghi file {path}: {e}")
             return False
 
 
-def save_exams_to_directory(exams, source_filename=None, target_dir=None, as_docx=False):
-    """Save each exam to a separate file in target_dir. Choose DOCX when as_docx=True."""
+def _valid_images(exams):
+    """Return qid -> existing attachment paths for the questions used in exams."""
+    valid = {}
+    if not images_map:
+        return valid
+    for qid in {q.get('id') for exam in exams for q in exam}:
+        ims = [im for im in sorted(images_map.get(qid, _EMPTY)) if os.path.exists(im)]
+        if ims:
+            valid[qid] = ims
+    return valid
+
+
+def _copy_attachments(exam, images_folder, existing, src_to_dst, valid_images, copied_map=None):
+    """Copy the attachments of `exam` into images_folder and return copied_map.
+
+    `existing` is the set of names already in images_folder, passed through
+    os.path.normcase so the collision check matches the file system (case-insensitive
+    on Windows), and `src_to_dst` memoizes source path -> copied name, so an attachment shared by several
+    exams is copied only once. Both are updated in place. `valid_images` is
+    the precomputed result of _valid_images().
+    """
+    if copied_map is None:
+        copied_map = {}
+    for q in exam:
+        qid = q.get('id')
+        for im in valid_images.get(qid, _EMPTY):
+            dst_name = src_to_dst.get(im)
+            if dst_name is None:
+                dst_name = os.path.basename(im)
+                # avoid overwrite by renaming
+                if os.path.normcase(dst_name) in existing:
+                    basef, extn = os.path.splitext(dst_name)
+                    k = 1
+                    while os.path.normcase(f"{basef}_{k}{extn}") in existing:
+                        k += 1
+                    dst_name = f"{basef}_{k}{extn}"
+                try:
+                    shutil.copy2(im, os.path.join(images_folder, dst_name))
+                except Exception as e:
+                    print(f"Không thể copy tệp {im}: {e}")
+                    continue
+                existing.add(os.path.normcase(dst_name))
+                src_to_dst[im] = dst_name
+            names = copied_map.setdefault(qid, [])
+            if dst_name not in names:
+                names.append(dst_name)
+            copied_map.setdefault(im, dst_name)
+    return copied_map
+
+
+def save_exams_to_directory(exams, source_filename=None, target_dir=None, as_docx=False, valid_images=None):
+    """Save each exam to a separate file in target_dir. Choose DOCX when as_docx=True.
+    When called off the Tk thread, pass `valid_images` (from _valid_images, taken on the
+    Tk thread) so images_map is not read while the UI may be changing it.
+    """
     if target_dir is None:
         target_dir = os.getcwd()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    now = datetime.now()
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+    created_at = now.strftime(_CREATED_AT_FORMAT)
     base_name = os.path.splitext(os.path.basename(source_filename))[0] if source_filename else f"de_thi_{timestamp}"
-    saved_files = []
     images_folder = os.path.join(target_dir, 'images')
-    os.makedirs(images_folder, exist_ok=True)
+    if valid_images is None:
+        valid_images = _valid_images(exams)
+    # only touch the images folder when some exam actually has attachments
+    if valid_images:
+        os.makedirs(images_folder, exist_ok=True)
+        existing = {os.path.normcase(e.name) for e in os.scandir(images_folder)}
+    src_to_dst = {}  # shared across exams so each attachment is copied once
+    png_cache = {}  # SVG conversions shared by the exams of this save only
+    jobs = []
     for i, exam in enumerate(exams, 1):
         suffix = chr(64 + i) if i <= 26 else str(i)
         ext = '.docx' if as_docx else '.txt'
         fn = f"{base_name}_de_{suffix}_{timestamp}{ext}"
         path = os.path.join(target_dir, fn)
         # Copy attachments used in this exam into images_folder and build mapping original->copied_basename
-        copied_map = {}
-        for q in exam:
-            for im in images_map.get(q.get('id'), []) or []:
-                if os.path.exists(im):
-                    dst_name = os.path.basename(im)
-                    dst_path = os.path.join(images_folder, dst_name)
-                    # avoid overwrite by renaming
-                    if os.path.exists(dst_path):
-                        basef, extn = os.path.splitext(dst_name)
-                        k = 1
-                        while os.path.exists(os.path.join(images_folder, f"{basef}_{k}{extn}")):
-                            k += 1
-                        dst_name = f"{basef}_{k}{extn}"
-                        dst_path = os.path.join(images_folder, dst_name)
-                    try:
-                        shutil.copy2(im, dst_path)
-                        copied_map.setdefault(q.get('id'), []).append(dst_name)
-                        copied_map.setdefault(im, dst_name)
-                    except Exception as e:
-                        print(f"Không thể copy tệp {im}: {e}")
-        ok = _write_exam_file(path, exam, suffix, source_filename, copied_map=copied_map, as_docx=as_docx)
-        # append attachment references at end of file (for txt files)
-        if copied_map and not as_docx:
-            try:
-                with open(path, 'a', encoding='utf-8') as f:
-                    f.write('\nTỆP ĐÍNH KÈM:\n')
-                    for q in exam:
-                        for dst in copied_map.get(q.get('id'), []):
-                            f.write(f"{q.get('id')}: images/{dst}\n")
-            except Exception as e:
-                print(f"Không thể ghi thông tin tệp đính kèm: {e}")
-        if ok:
-            saved_files.append(path)
-    return saved_files
+        copied_map = _copy_attachments(exam, images_folder, existing, src_to_dst, valid_images) if valid_images else {}
+        jobs.append((path, exam, suffix, copied_map))
+    if not jobs:
+        return []
+    # Writing is I/O bound, so the files are written concurrently
+    with ThreadPoolExecutor(max_workers=min(_MAX_SAVE_WORKERS, len(jobs))) as ex:
+        futures = [ex.submit(_write_exam_file, path, exam, suffix, source_filename,
+                             copied_map=copied_map, as_docx=as_docx, created_at=created_at,
+                             png_cache=png_cache)
+                   for path, exam, suffix, copied_map in jobs]
+        return [job[0] for job, fut in zip(jobs, futures) if fut.result()]
+
+
+def _iter_exams_text(exams, copied_map, created_at):
+    """Yield the combined plain-text output chunk by chunk."""
+    yield "KẾT QUẢ TẠO ĐỀ THI\n"
+    yield f"Thời gian: {created_at}\n"
+    yield f"Số mã đề: {len(exams)}\n\n"
+    for idx, exam in enumerate(exams, 1):
+        yield f"{'='*50}\nMÃ ĐỀ {idx}\n{'='*50}\n\n"
+        for q_idx, q in enumerate(exam, 1):
+            yield _format_question_full(q, q_idx) + "\n"
+            # write references using copied_map if available
+            for dst in copied_map.get(q.get('id'), _EMPTY):
+                yield f"Tệp đính kèm: images/{dst}\n"
+            yield "\n"
+        yield "\n" + "="*50 + "\n\n"
+
+
+def write_exams_text(f, exams, copied_map=None, created_at=None):
+    """Write all exams as plain text to the open file f. Memory use stays at one
+    question at a time; the file's own buffer batches the writes.
+    """
+    if created_at is None:
+        created_at = datetime.now().strftime(_CREATED_AT_FORMAT)
+    f.writelines(_iter_exams_text(exams, copied_map or {}, created_at))
 
 
 def save_exams_combined(exams, filepath, source_filename=None):
+    created_at = datetime.now().strftime(_CREATED_AT_FORMAT)
     try:
         out_dir = os.path.dirname(filepath) or os.getcwd()
         images_folder = os.path.join(out_dir, 'images')
-        os.makedirs(images_folder, exist_ok=True)
         # copy all attachments used across exams and record mapping original->copied basename
+        valid_images = _valid_images(exams)
         copied_map = {}
-        for exam in exams:
-            for q in exam:
-                for im in images_map.get(q.get('id'), []) or []:
-                    if os.path.exists(im):
-                        dst_name = os.path.basename(im)
-                        dst_path = os.path.join(images_folder, dst_name)
-                        if os.path.exists(dst_path):
-                            base, ext = os.path.splitext(dst_name)
-                            k = 1
-                            while os.path.exists(os.path.join(images_folder, f"{base}_{k}{ext}")):
-                                k += 1
-                            dst_name = f"{base}_{k}{ext}"
-                            dst_path = os.path.join(images_folder, dst_name)
-                        try:
-                            shutil.copy2(im, dst_path)
-                            copied_map.setdefault(q.get('id'), []).append(dst_name)
-                            copied_map.setdefault(im, dst_name)
-                        except Exception as e:
-                            print(f"Không thể copy tệp {im}: {e}")
+        if valid_images:
+            os.makedirs(images_folder, exist_ok=True)
+            existing = {os.path.normcase(e.name) for e in os.scandir(images_folder)}
+            src_to_dst = {}
+            for exam in exams:
+                _copy_attachments(exam, images_folder, existing, src_to_dst, valid_images, copied_map)
 
         # If filepath indicates .docx and DOCX_AVAILABLE then write docx combined
         if filepath.lower().endswith('.docx'):
@@ -503,14 +717,15 @@ def save_exams_combined(exams, filepath, source_filename=None):
                 return None
             try:
                 doc = Document()
+                image_cache = {}  # path -> prepared bytes, shared by every exam in the document
+                png_cache = {}  # path -> converted SVG bytes, likewise
                 doc.add_heading('KẾT QUẢ TẠO ĐỀ THI', level=1)
-                doc.add_paragraph(f"Thời gian: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+                doc.add_paragraph(f"Thời gian: {created_at}")
                 doc.add_paragraph(f"Số mã đề: {len(exams)}")
                 for idx, exam in enumerate(exams, 1):
                     doc.add_page_break()
                     doc.add_heading(f"MÃ ĐỀ {idx}", level=2)
-                    ordered = [q for q in exam if q.get('type') == 'MCQ'] + [q for q in exam if q.get('type') == 'ESSAY']
-                    for q_idx, q in enumerate(ordered, 1):
+                    for q_idx, q in enumerate(exam, 1):
                         # create a two-column table so image(s) appear beside question
                         tbl = doc.add_table(rows=1, cols=2)
                         tbl.autofit = True
@@ -519,75 +734,106 @@ def save_exams_combined(exams, filepath, source_filename=None):
                         right = tbl.rows[0].cells[1]
                         left.add_paragraph(f"Câu {q_idx}: [{q['level']}] {q['question']}")
                         if q['type'] == 'MCQ' and any(q['options']):
-                            for i, opt in enumerate(q['options']):
+                            for letter, opt in zip(_OPT_LETTERS, q['options']):
                                 if opt.strip():
-                                    left.add_paragraph(f"{chr(65+i)}. {opt}")
+                                    left.add_paragraph(f"{letter}. {opt}")
                         if q.get('answer'):
                             left.add_paragraph(f"Đáp án: {q.get('answer')}")
 
-                        for dst in copied_map.get(q.get('id'), []) or []:
+                        for dst in copied_map.get(q.get('id'), _EMPTY):
                             dst_path = os.path.join(images_folder, dst)
                             ext = os.path.splitext(dst)[1].lower()
                             embedded = False
                             if ext == '.svg':
-                                conv = _convert_to_png(dst_path)
+                                conv = _convert_to_png_bytes(dst_path, png_cache)
                                 if conv:
                                     rp = right.add_paragraph()
                                     embedded = _embed_image_in_paragraph(rp, conv, width_inch=4)
                             elif ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.jfif']:
                                 rp = right.add_paragraph()
-                                embedded = _embed_image_in_paragraph(rp, dst_path, width_inch=4)
+                                embedded = _embed_image_in_paragraph(rp, dst_path, width_inch=4, cache=image_cache)
                             if not embedded:
                                 right.add_paragraph(f"Tệp đính kèm: images/{dst}")
                         doc.add_paragraph('')
-                doc.save(filepath)
+                with open(filepath, 'wb', buffering=_DOCX_BUFFER_SIZE) as fh:
+                    doc.save(fh)
                 return filepath
             except Exception as e:
                 print(f"Lỗi khi lưu docx: {e}")
                 return None
 
-        # default: write plain text
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(f"KẾT QUẢ TẠO ĐỀ THI\n")
-            f.write(f"Thời gian: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Số mã đề: {len(exams)}\n\n")
-            for idx, exam in enumerate(exams, 1):
-                f.write(f"{'='*50}\n")
-                f.write(f"MÃ ĐỀ {idx}\n")
-                f.write(f"{'='*50}\n\n")
-                for q_idx, q in enumerate(exam, 1):
-                    f.write(format_question(q, q_idx, show_answers=True, show_hints=True) + "\n")
-                    # write references using copied_map if available
-                    for dst in copied_map.get(q.get('id'), []) or []:
-                        f.write(f"Tệp đính kèm: images/{dst}\n")
-                    f.write("\n")
-                f.write("\n" + "="*50 + "\n\n")
+        # default: write plain text, streamed one question at a time
+        with open(filepath, 'w', encoding='utf-8', buffering=_WRITE_BUFFER_SIZE) as f:
+            write_exams_text(f, exams, copied_map, created_at)
         return filepath
     except Exception as e:
         print(f"Lỗi khi lưu file: {e}")
         return None
 
 
+def _load_thumbnail(fp, size=(80, 80)):
+    """Decode a small preview of an image file, or None. Safe to run in a worker thread."""
+    try:
+        img = Image.open(fp)
+        img.draft('RGB', size)  # JPEG: let the decoder downscale while decoding
+        img.thumbnail(size, Image.BILINEAR)
+        return img
+    except Exception:
+        return None
+
+
+def _bigram_index(keys):
+    """Map every 2-character substring to the set of keys containing it."""
+    index = defaultdict(set)
+    for key in keys:
+        for i in range(len(key) - 1):
+            index[key[i:i + 2]].add(key)
+    return index
+
+
+def build_qid_matcher(qids):
+    """Return match(name) -> the QID contained in name (case-insensitive), or None.
+    The longest QID wins so that e.g. Q10 is preferred over Q1 for "q10.png"; among
+    equally long QIDs the one occurring first in the name wins ("q001_q002.png" -> Q001).
+    Both code paths below break ties the same way.
+    """
+    if AHOCORASICK_AVAILABLE and qids:
+        auto = ahocorasick.Automaton()
+        for qid in qids:
+            key = qid.lower()
+            if key not in auto:  # first QID in the bank wins, as in the fallback
+                auto.add_word(key, qid)
+        auto.make_automaton()
+
+        def match(name):
+            # matches arrive ordered by end position, so for equal lengths the
+            # first one seen is also the first to start
+            best = None
+            for _end, qid in auto.iter(name.lower()):
+                if best is None or len(qid) > len(best):
+                    best = qid
+            return best
+        return match
+
+    # lowercase every QID once, longest first
+    qids_lc = sorted(((qid.lower(), qid) for qid in qids), key=lambda p: len(p[0]), reverse=True)
+
+    def match(name):
+        name_lc = name.lower()
+        best = None
+        for lc, orig in qids_lc:
+            if best is not None and len(lc) < best_len:
+                break
+            pos = name_lc.find(lc)
+            if pos >= 0 and (best is None or pos < best_pos):
+                best, best_len, best_pos = orig, len(lc), pos
+        return best
+    return match
+
+
 def parse_dnd_paths(data):
-    paths = []
-    data = data.strip()
-    if data.startswith('{'):
-        cur = ''
-        in_brace = False
-        for ch in data:
-            if ch == '{':
-                in_brace = True
-                cur = ''
-            elif ch == '}':
-                in_brace = False
-                if cur:
-                    paths.append(cur)
-                cur = ''
-            elif in_brace:
-                cur += ch
-    else:
-        paths = [p.strip() for p in data.split()]
-    return paths
+    """Split a Tk drop payload into paths; paths containing spaces arrive wrapped in braces."""
+    return [braced or bare for braced, bare in _DND_TOKEN_RE.findall(data) if braced or bare]
 
 
 class ExamGeneratorApp:
@@ -596,6 +842,10 @@ class ExamGeneratorApp:
         self.root.title("Ngân Hàng Câu Hỏi - Tạo Đề Thi Chuyên Nghiệp")
         self.root.geometry("1000x700")
         self.root.attributes('-topmost', True)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._rng = random.Random(42)  # Để tái tạo kết quả giữa các lần chạy
+        self._thumb_executor = ThreadPoolExecutor(max_workers=4)
+        self._thumb_cache = OrderedDict()  # fp -> PhotoImage, least recently used first
         
         style = ttk.Style()
         style.theme_use('clam')  # Theme hiện đại
@@ -658,7 +908,9 @@ class ExamGeneratorApp:
         btn_frame = ttk.Frame(root)
         btn_frame.pack(fill='x', padx=10, pady=10)
         ttk.Button(btn_frame, text="Tạo Mã Đề", command=self.generate_exams).pack(side='left', padx=5)
-        ttk.Button(btn_frame, text="Lưu Đề Ra File", command=self.save_exams).pack(side='left', padx=5)
+        # kept so it can be disabled while a background save is running
+        self.save_button = ttk.Button(btn_frame, text="Lưu Đề Ra File", command=self.save_exams)
+        self.save_button.pack(side='left', padx=5)
         ttk.Button(btn_frame, text="Quản lý hình", command=self.manage_images).pack(side='left', padx=5)
         ttk.Button(btn_frame, text="Đóng", command=root.destroy).pack(side='right', padx=5)
         
@@ -671,6 +923,46 @@ class ExamGeneratorApp:
     def update_status(self, text):
         self.status_label.config(text=text)
 
+    def set_display_text(self, text):
+        """Replace the preview contents with text in a single insert (read-only afterwards)."""
+        td = self.text_display
+        td.configure(state=tk.NORMAL)
+        td.delete('1.0', tk.END)
+        td.insert('1.0', text)
+        td.configure(state=tk.DISABLED)
+        # scroll back to the top once, instead of following each insert
+        td.mark_set('insert', '1.0')
+        td.see('1.0')
+
+    def _cache_thumbnail(self, fp, tkimg):
+        """Store a thumbnail PhotoImage (or None if unreadable), evicting the least recently used."""
+        cache = self._thumb_cache
+        cache[fp] = tkimg
+        cache.move_to_end(fp)
+        while len(cache) > _THUMB_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def run_in_background(self, on_done, func, *args, on_error=None, **kwargs):
+        """Run func in a worker thread, then call on_done(result) on the Tk thread.
+        If func raises, the error is reported and on_error() (if given) is called instead.
+        """
+        future = self._executor.submit(func, *args, **kwargs)
+
+        def poll():
+            if not future.done():
+                self.root.after(100, poll)
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                self.update_status("Thao tác thất bại")
+                messagebox.showerror("Lỗi", f"Thao tác thất bại: {e}")
+                if on_error is not None:
+                    on_error()
+                return
+            on_done(result)
+        poll()
+
     def browse_file(self):
         fp = filedialog.askopenfilename(
             title="Chọn file ngân hàng câu hỏi",
@@ -696,14 +988,15 @@ class ExamGeneratorApp:
             return
         # Try to auto-detect QID from filename
         qids = [q['id'] for q in loaded_questions]
+        # the matcher is rebuilt only when a new bank has been loaded
+        if getattr(self, '_qid_matcher_bank', None) is not loaded_questions:
+            self._qid_matcher = build_qid_matcher(qids)
+            self._qid_matcher_bank = loaded_questions
+        basenames = [os.path.basename(fp) for fp in fps]
+        exts = [os.path.splitext(b)[1].lower() for b in basenames]
         auto_matches = {}
-        for fp in fps:
-            name = os.path.basename(fp)
-            found = None
-            for qid in qids:
-                if qid.lower() in name.lower():
-                    found = qid
-                    break
+        for fp, base in zip(fps, basenames):
+            found = self._qid_matcher(base)
             if found:
                 auto_matches[fp] = found
 
@@ -714,89 +1007,192 @@ class ExamGeneratorApp:
         frm = ttk.Frame(dlg, padding=10)
         frm.pack(fill='both', expand=True)
 
-        ttk.Label(frm, text='Gõ mã câu (QID) hoặc danh sách QID cách nhau bởi dấu phẩy. Để trống để bỏ qua.', wraplength=700).pack(pady=(0,8))
+        ttk.Label(frm, text='Gõ mã câu (QID) hoặc danh sách QID cách nhau bởi dấu phẩy. Để trống để bỏ qua.', wraplength=700).pack(pady=(0,2))
+        ttk.Label(frm, text='Ví dụ: Q001 hoặc Q001,Q002').pack(pady=(0,8))
 
-        canvas = tk.Canvas(frm)
+        # Rows are virtualized: only a small pool of row slots (one Entry plus a few
+        # canvas items each) exists, and the slots are moved onto whichever rows
+        # are currently visible. Entry state lives in the StringVars of `rows`.
+        canvas = tk.Canvas(frm, highlightthickness=0)
         scrollbar = ttk.Scrollbar(frm, orient='vertical', command=canvas.yview)
-        inner = ttk.Frame(canvas)
-        inner.bind('<Configure>', lambda e: canvas.configure(scrollregion=canvas.bbox('all')))
-        canvas.create_window((0,0), window=inner, anchor='nw')
-        canvas.configure(yscrollcommand=scrollbar.set)
         canvas.pack(side='left', fill='both', expand=True)
         scrollbar.pack(side='right', fill='y')
 
-        # Try to import PIL for thumbnails
-        try:
-            from PIL import Image, ImageTk
-            PIL_AVAILABLE = True
-        except Exception:
-            PIL_AVAILABLE = False
-
-        rows = []
-        for fp in fps:
-            base = os.path.basename(fp)
-            row = ttk.Frame(inner)
-            row.pack(fill='x', pady=6, padx=4)
-            left = ttk.Frame(row)
-            left.pack(side='left')
-            # show thumbnail only for image file types
-            ext = os.path.splitext(base)[1].lower()
-            if ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'] and PIL_AVAILABLE:
+        row_h = _ASSIGN_ROW_HEIGHT
+        total_h = row_h * len(fps)
+        # prefill with auto match if available
+        rows = [(fp, tk.StringVar(value=auto_matches.get(fp, ''))) for fp in fps]
+        pending = {}  # fp -> future of a thumbnail being decoded in the background
+        poll_after = None  # id of the scheduled collect_thumbnails call
+        slots = []
+
+        def thumbnail(i):
+            # show thumbnail only for image file types; returns (image, marker text)
+            fp = fps[i]
+            if exts[i] not in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'] or not PIL_AVAILABLE:
+                return '', '[Tệp]'
+            cache = self._thumb_cache
+            if fp in cache:
+                cache.move_to_end(fp)
+                if cache[fp] is None:
+                    return '', '[Hình không xem được]'
+                return cache[fp], ''
+            if fp not in pending:
+                pending[fp] = self._thumb_executor.submit(_load_thumbnail, fp)
+                if len(pending) == 1:
+                    schedule_collect()
+            return '', '[Đang tải...]'
+
+        def schedule_collect():
+            # scheduled on root: an after callback owned by dlg would be deleted
+            # with the dialog and fire as an "invalid command name" error
+            nonlocal poll_after
+            poll_after = self.root.after(50, collect_thumbnails)
+
+        def collect_thumbnails():
+            # PhotoImages must be created on the Tk thread, so decoded images are
+            # picked up here and the rows showing them are redrawn
+            nonlocal poll_after
+            poll_after = None
+            if not dlg.winfo_exists():
+                return
+            for fp, future in list(pending.items()):
+                if not future.done():
+                    continue
+                del pending[fp]
+                img = future.result()
                 try:
-                    img = Image.open(fp)
-                    img.thumbnail((80,80))
-                    tkimg = ImageTk.PhotoImage(img)
-                    lbl = ttk.Label(left, image=tkimg)
-                    lbl.image = tkimg
-                    lbl.pack()
+                    tkimg = ImageTk.PhotoImage(img) if img is not None else None
                 except Exception:
-                    ttk.Label(left, text='[Hình không xem được]').pack()
-            else:
-                ttk.Label(left, text='[Tệp]').pack()
-
-            mid = ttk.Frame(row)
-            mid.pack(side='left', fill='x', expand=True, padx=8)
-            ttk.Label(mid, text=base).pack(anchor='w')
-            var = tk.StringVar()
-            # prefill with auto match if available
-            if fp in auto_matches:
-                var.set(auto_matches[fp])
-            entry = ttk.Entry(mid, textvariable=var, width=30)
-            entry.pack(anchor='w', pady=2)
-            ttk.Label(mid, text='Ví dụ: Q001 hoặc Q001,Q002').pack(anchor='w')
-            rows.append((fp, var))
+                    tkimg = None
+                self._cache_thumbnail(fp, tkimg)
+                for slot in slots:
+                    if slot['row'] is not None and fps[slot['row']] == fp:
+                        place_slot(slot, slot['row'])
+            if pending:
+                schedule_collect()
+
+        def make_slot():
+            entry = ttk.Entry(canvas, width=30)
+            return {
+                'row': None,
+                'image': canvas.create_image(0, 0),
+                'marker': canvas.create_text(0, 0, anchor='nw', width=88),
+                'name': canvas.create_text(0, 0, anchor='nw'),
+                'entry': entry,
+                'window': canvas.create_window(0, 0, window=entry, anchor='nw'),
+            }
+
+        def place_slot(slot, i):
+            # i is None to park the slot above the scroll region
+            slot['row'] = i
+            y = i * row_h + 6 if i is not None else -2 * row_h
+            canvas.coords(slot['image'], 44, y + 40)
+            canvas.coords(slot['marker'], 4, y)
+            canvas.coords(slot['name'], 100, y)
+            canvas.coords(slot['window'], 100, y + 22)
+            if i is not None:
+                tkimg, marker = thumbnail(i)
+                canvas.itemconfigure(slot['image'], image=tkimg)
+                canvas.itemconfigure(slot['marker'], text=marker)
+                canvas.itemconfigure(slot['name'], text=basenames[i])
+                slot['entry'].configure(textvariable=rows[i][1])
+
+        def render_visible(*_):
+            top = int(canvas.canvasy(0))
+            bottom = top + canvas.winfo_height()
+            i0 = max(0, top // row_h)
+            i1 = min(len(rows), bottom // row_h + 1)
+            while len(slots) < i1 - i0:
+                slots.append(make_slot())
+            # row i always uses slot i % len(slots), so scrolling by one row only
+            # moves the slot that wrapped around
+            used = set()
+            for i in range(i0, i1):
+                k = i % len(slots)
+                used.add(k)
+                if slots[k]['row'] != i:
+                    place_slot(slots[k], i)
+            for k, slot in enumerate(slots):
+                if k not in used and slot['row'] is not None:
+                    place_slot(slot, None)
+
+        def on_yview(first, last):
+            scrollbar.set(first, last)
+            render_visible()
+
+        # the content height only depends on the row count, so the scroll region is
+        # set once here; resizes just re-render the visible rows
+        canvas.configure(yscrollcommand=on_yview, scrollregion=(0, 0, 0, total_h))
+        canvas.bind('<Configure>', render_visible)
+
+        def close_dialog():
+            # drop the dialog's references (queued decodes, pending poll, row slots)
+            # so its thumbnails can be freed; only the bounded LRU cache keeps any
+            nonlocal poll_after
+            if poll_after is not None:
+                self.root.after_cancel(poll_after)
+                poll_after = None
+            for future in pending.values():
+                future.cancel()
+            pending.clear()
+            slots.clear()
+            dlg.destroy()
+
+        dlg.protocol('WM_DELETE_WINDOW', close_dialog)
 
         def apply_assign():
             assigned = 0
             skipped = []
             qid_map = {q.upper(): q for q in qids}
+            bigrams = None  # built on the first partial lookup
+
+            def partial_matches(t):
+                # QIDs containing token t; narrowed through the 2-gram index
+                nonlocal bigrams
+                if len(t) < 2:
+                    return [v for k, v in qid_map.items() if t in k]
+                if bigrams is None:
+                    bigrams = _bigram_index(qid_map)
+                pool = set.intersection(*(bigrams.get(t[i:i + 2], set()) for i in range(len(t) - 1)))
+                return [qid_map[k] for k in pool if t in k]
+
+            qid_map_get = qid_map.get
+            images_map_setdefault = images_map.setdefault
+
+            def attach(real, fp):
+                attached = images_map_setdefault(real, set())
+                if fp in attached:
+                    return 0
+                attached.add(fp)
+                return 1
+
             for fp, var in rows:
                 txt = var.get().strip()
                 if not txt:
                     continue
-                # support multiple QIDs separated by commas
-                for token in [t.strip() for t in txt.split(',') if t.strip()]:
+                # support multiple QIDs separated by commas; a single QID needs no split
+                if ',' not in txt:
+                    tokens = (txt,)
+                else:
+                    tokens = filter(None, (t.strip() for t in txt.split(',')))
+                for token in tokens:
                     t = token.upper()
-                    if t in qid_map:
-                        real = qid_map[t]
-                        if fp not in images_map.setdefault(real, []):
-                            images_map.setdefault(real, []).append(fp)
-                            assigned += 1
+                    real = qid_map_get(t)
+                    if real is not None:
+                        assigned += attach(real, fp)
                     else:
                         # try partial match (token contained in a known QID)
-                        candidates = [v for k, v in qid_map.items() if t in k]
+                        candidates = partial_matches(t)
                         if len(candidates) == 1:
-                            real = candidates[0]
-                            if fp not in images_map.setdefault(real, []):
-                                images_map.setdefault(real, []).append(fp)
-                                assigned += 1
+                            assigned += attach(candidates[0], fp)
                         else:
                             skipped.append(token)
-            dlg.destroy()
-            msg = f'Đã gán {assigned} tệp vào câu tương ứng.'
+            close_dialog()
+            msg = [f'Đã gán {assigned} tệp vào câu tương ứng.']
             if skipped:
-                msg += f"\nBỏ qua {len(skipped)} mã không tìm thấy: {', '.join(skipped)}"
-            messagebox.showinfo('Xong', msg)
+                msg.append(f"Bỏ qua {len(skipped)} mã không tìm thấy: {', '.join(skipped)}")
+            messagebox.showinfo('Xong', '\n'.join(msg))
 
         ttk.Button(frm, text='Áp dụng', command=apply_assign).pack(pady=8)
 
@@ -812,11 +1208,13 @@ class ExamGeneratorApp:
         if not images_map:
             text.insert('1.0', 'Chưa có hình được gán.')
         else:
+            parts = []
             for qid, fps in images_map.items():
-                text.insert(tk.END, f"{qid}:\n")
-                for p in fps:
-                    text.insert(tk.END, f"  - {p}\n")
-                text.insert(tk.END, "\n")
+                parts.append(f"{qid}:\n")
+                for p in sorted(fps):
+                    parts.append(f"  - {p}\n")
+                parts.append("\n")
+            text.insert('1.0', ''.join(parts))
         text.config(state=tk.DISABLED)
 
     def load_file(self, path):
@@ -832,16 +1230,18 @@ class ExamGeneratorApp:
         mcq_count = sum(1 for q in questions if q['type'] == 'MCQ')
         essay_count = total - mcq_count
         
-        self.text_display.delete('1.0', tk.END)
-        self.text_display.insert(tk.END, f"ĐÃ TẢI THÀNH CÔNG FILE:\n{os.path.basename(path)}\n\n")
-        self.text_display.insert(tk.END, f"Tổng cộng: {total} câu hỏi\n")
-        self.text_display.insert(tk.END, f"  • Trắc nghiệm: {mcq_count} câu\n")
-        self.text_display.insert(tk.END, f"  • Tự luận: {essay_count} câu\n\n")
-        self.text_display.insert(tk.END, "Xem trước 15 câu đầu:\n" + "-"*50 + "\n")
+        parts = [
+            f"ĐÃ TẢI THÀNH CÔNG FILE:\n{os.path.basename(path)}\n\n",
+            f"Tổng cộng: {total} câu hỏi\n",
+            f"  • Trắc nghiệm: {mcq_count} câu\n",
+            f"  • Tự luận: {essay_count} câu\n\n",
+            "Xem trước 15 câu đầu:\n" + "-"*50 + "\n",
+        ]
         for i, q in enumerate(questions[:15], 1):
-            self.text_display.insert(tk.END, format_question(q, i) + "\n\n")
+            parts.append(format_question(q, i) + "\n\n")
         if total > 15:
-            self.text_display.insert(tk.END, f"... và {total-15} câu nữa.\n")
+            parts.append(f"... và {total-15} câu nữa.\n")
+        self.set_display_text(''.join(parts))
         
         self.update_status(f"Đã tải {total} câu hỏi")
 
@@ -857,45 +1257,56 @@ class ExamGeneratorApp:
         total_per_exam = req_mcq + req_essay
         
         # Thông báo cấu hình
-        info = f"SẮP TẠO {N} MÃ ĐỀ\n"
-        info += f"Mỗi đề có: {total_per_exam} câu\n"
-        info += f"  • Trắc nghiệm: {req_mcq} câu\n"
-        info += f"  • Tự luận: {req_essay} câu\n"
+        info = [
+            f"SẮP TẠO {N} MÃ ĐỀ",
+            f"Mỗi đề có: {total_per_exam} câu",
+            f"  • Trắc nghiệm: {req_mcq} câu",
+            f"  • Tự luận: {req_essay} câu",
+        ]
         if any(req_level.values()):
-            info += "Phân bổ theo mức độ:\n"
-            for lev, cnt in req_level.items():
-                if cnt > 0:
-                    info += f"    - {lev}: {cnt} câu\n"
+            info.append("Phân bổ theo mức độ:")
+            info.extend(f"    - {lev}: {cnt} câu" for lev, cnt in req_level.items() if cnt > 0)
+        info.extend(["", "Tiếp tục?"])
         
-        if not messagebox.askyesno("Xác nhận tạo đề", info + "\nTiếp tục?"):
+        if not messagebox.askyesno("Xác nhận tạo đề", "\n".join(info)):
             return
         
-        versions = generate_versions(loaded_questions, N, req_level, req_mcq, req_essay)
+        versions = generate_versions(loaded_questions, N, req_level, req_mcq, req_essay, rng=self._rng)
         self.generated_versions = versions
         
-        self.text_display.delete('1.0', tk.END)
-        self.text_display.insert(tk.END, f"HOÀN THÀNH! ĐÃ TẠO THÀNH CÔNG {N} MÃ ĐỀ\n")
-        self.text_display.insert(tk.END, f"Mỗi đề có khoảng {total_per_exam} câu (có thể thay đổi nhẹ nếu thiếu câu)\n\n")
-        self.text_display.insert(tk.END, "="*80 + "\n\n")
-        
+        parts = [
+            f"HOÀN THÀNH! ĐÃ TẠO THÀNH CÔNG {N} MÃ ĐỀ\n",
+            f"Mỗi đề có khoảng {total_per_exam} câu (có thể thay đổi nhẹ nếu thiếu câu)\n\n",
+            "="*80 + "\n\n",
+        ]
+        images_get = images_map.get
+        # the same question shows up in many versions; format its body only once
+        bodies = {}
         for i, ver in enumerate(versions, 1):
+            # generate_versions already orders each version MCQ first, then ESSAY
             actual_total = len(ver)
-            actual_mcq = sum(1 for q in ver if q['type'] == 'MCQ')
-            self.text_display.insert(tk.END, f"MÃ ĐỀ {i} ({actual_total} câu: {actual_mcq} TN + {actual_total-actual_mcq} TL)\n")
-            self.text_display.insert(tk.END, "-"*60 + "\n")
-            ordered = [q for q in ver if q.get('type') == 'MCQ'] + [q for q in ver if q.get('type') == 'ESSAY']
-            for j, q in enumerate(ordered, 1):
-                    self.text_display.insert(tk.END, format_question(q, j) + "\n")
-                    # show associated files
-                    for im in images_map.get(q.get('id'), []) or []:
-                        self.text_display.insert(tk.END, f"Tệp đính kèm: {os.path.basename(im)}\n")
-                    self.text_display.insert(tk.END, "\n")
-            self.text_display.insert(tk.END, "\n" + "="*80 + "\n\n")
+            actual_mcq = sum(1 for q in ver if q.get('type') == 'MCQ')
+            parts.append(f"MÃ ĐỀ {i} ({actual_total} câu: {actual_mcq} TN + {actual_total-actual_mcq} TL)\n")
+            parts.append("-"*60 + "\n")
+            for j, q in enumerate(ver, 1):
+                body = bodies.get(id(q))
+                if body is None:
+                    body = bodies[id(q)] = _format_question_body(q)
+                parts.append(f"Câu {j}: {body}\n")
+                # show associated files
+                for im in sorted(images_get(q.get('id'), _EMPTY)):
+                    parts.append(f"Tệp đính kèm: {os.path.basename(im)}\n")
+                parts.append("\n")
+            parts.append("\n" + "="*80 + "\n\n")
+        self.set_display_text(''.join(parts))
         
         self.update_status(f"Đã tạo {N} mã đề")
+        # one repaint for the new preview and status text
+        self.root.update_idletasks()
 
     def save_exams(self):
-        if not self.text_display.get('1.0', 'end').strip():
+        # O(1) emptiness check; get() would copy the whole preview across Tcl
+        if self.text_display.index('end-1c') == '1.0':
             messagebox.showinfo("Chưa có nội dung", "Chưa tạo đề để lưu!")
             return
         # If we have generated versions, offer per-file save option
@@ -911,9 +1322,25 @@ class ExamGeneratorApp:
                 if as_docx and not DOCX_AVAILABLE:
                     messagebox.showwarning("Thiếu thư viện", "Không thể lưu .docx vì python-docx chưa được cài. Cài bằng: pip install python-docx")
                     as_docx = False
-                saved = save_exams_to_directory(self.generated_versions, getattr(self, 'current_filename', None), target_dir, as_docx=as_docx)
-                if saved:
-                    messagebox.showinfo("Đã lưu", f"Đã lưu {len(saved)} file vào:\n{target_dir}")
+                def enable_save():
+                    self.save_button.configure(state=tk.NORMAL)
+
+                def on_saved(saved):
+                    enable_save()
+                    self.update_status(f"Đã lưu {len(saved)} file")
+                    if saved:
+                        messagebox.showinfo("Đã lưu", f"Đã lưu {len(saved)} file vào:\n{target_dir}")
+
+                # save off the Tk thread so the window stays responsive; the attachment
+                # list is snapshotted here since the assign dialog may edit images_map meanwhile
+                # a second save into the same folder would overwrite this one, so the
+                # button stays disabled until it finishes
+                self.save_button.configure(state=tk.DISABLED)
+                self.update_status("Đang lưu các mã đề...")
+                self.run_in_background(on_saved, save_exams_to_directory, self.generated_versions,
+                                       getattr(self, 'current_filename', None), target_dir, as_docx=as_docx,
+                                       valid_images=_valid_images(self.generated_versions),
+                                       on_error=enable_save)
                 return
 
         # default: save combined file
@@ -932,7 +1359,7 @@ class ExamGeneratorApp:
                     messagebox.showwarning("Thiếu thư viện", "Không thể lưu .docx vì python-docx chưa được cài. Cài bằng: pip install python-docx")
             else:
                 try:
-                    with open(fp, 'w', encoding='utf-8') as f:
+                    with open(fp, 'w', encoding='utf-8', buffering=_WRITE_BUFFER_SIZE) as f:
                         f.write(self.text_display.get('1.0', tk.END))
                     success = True
                 except Exception as e:
@@ -956,5 +1383,4 @@ def main():
 
 
 if __name__ == "__main__":
-    random.seed(42)  # Để tái tạo kết quả
     main()
\ No newline at end of file